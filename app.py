@@ -4,13 +4,22 @@ Flask app that shows weather conditions along a driving route,
 fetching forecast data from Open-Meteo using the ECMWF IFS model.
 """
 
+import hashlib
+import html
+import json
 import os
+import string
+import threading
 import folium
+import numpy as np
+from branca.element import MacroElement
+from collections import OrderedDict
 from flask import Flask, render_template, request
+from jinja2 import Template
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
-from routing import geocode, get_route, sample_waypoints, estimate_arrival_times
+from routing import Waypoints, geocode, get_route, sample_waypoints, estimate_arrival_times
 from weather import fetch_weather_for_waypoints
 
 load_dotenv()
@@ -58,6 +67,8 @@ def plan():
         return render_template("index.html", errors=["Invalid date/time format."], missing_keys=[])
 
     # -- Geocode ---------------------------------------------------------------
+    # Sequential on purpose: geocode() spaces Nominatim calls 1 s apart, so
+    # running these concurrently would not save any time.
     start_coords = geocode(start_addr)
     end_coords   = geocode(end_addr)
 
@@ -100,7 +111,7 @@ def plan():
     return render_template(
         "result.html",
         map_html=map_html,
-        waypoints=waypoints,
+        waypoints=waypoints.to_dicts(),
         start=start_addr,
         end=end_addr,
         total_mi=round(total_dist_mi, 1),
@@ -113,17 +124,21 @@ def plan():
 
 # --- Helpers ------------------------------------------------------------------
 
-def precip_dot_color(weather: dict) -> str:
-    """
-    Map precip_type from the WMO weather code to a marker color name.
-    Priority: wind warning > thunderstorm > freezing > snow > rain > cloud > clear
-    """
-    if not weather or not weather.get("available"):
-        return "blue"
-    if weather.get("wind_warning"):
-        return "red"
-    pt = weather.get("precip_type")
-    return {
+FILL_COLORS = {
+    "green":     "#2ECC71",
+    "gray":      "#95A5A6",
+    "orange":    "#E67E22",
+    "yellow":    "#F4D03F",
+    "red":       "#E74C3C",
+    "purple":    "#9B59B6",
+    "blue_snow": "#5DADE2",
+    "blue":      "#3498DB",
+}
+
+# precip_type → (marker color name, fill hex), resolved once at import
+_PRECIP_COLORS = {
+    pt: (name, FILL_COLORS[name])
+    for pt, name in {
         "thunderstorm":  "purple",
         "freezing_rain": "orange",
         "snow":          "blue_snow",
@@ -132,135 +147,225 @@ def precip_dot_color(weather: dict) -> str:
         "showers":       "yellow",
         "rain":          "yellow",
         "fog":           "gray",
-    }.get(pt, "green" if weather.get("cloud_pct", 0) <= 75 else "gray")
+    }.items()
+}
 
 
-FILL_COLORS = {
-    "green":     "#2ECC71",
-    "gray":      "#95A5A6",
-    "orange":    "#E67E22",
-    "yellow":    "#F4D03F",
-    "red":       "#E74C3C",
-    "purple":    "#9B59B6",
-    "blue_snow": "#5DADE2",
-    "blue":      "#3498DB",
+def precip_dot_color(weather: dict) -> tuple[str, str]:
+    """
+    Map precip_type from the WMO weather code to a marker (color name, fill hex).
+    Priority: wind warning > thunderstorm > freezing > snow > rain > cloud > clear
+    """
+    if not weather or not weather.get("available"):
+        return "blue", FILL_COLORS["blue"]
+    if weather.get("wind_warning"):
+        return "red", FILL_COLORS["red"]
+    colors = _PRECIP_COLORS.get(weather.get("precip_type"))
+    if colors:
+        return colors
+    if weather.get("cloud_pct", 0) <= 75:
+        return "green", FILL_COLORS["green"]
+    return "gray", FILL_COLORS["gray"]
+
+
+# --- Popup templates ----------------------------------------------------------
+
+_POPUP_TMPL = string.Template("""
+            <div style="font-family:sans-serif;min-width:200px">
+              <div style="font-size:14px;font-weight:bold;margin-bottom:2px">$label</div>
+              <div style="color:#888;font-size:12px;margin-bottom:6px">Arrives ~$arrival</div>
+              <div style="font-size:12px;color:#555;margin-bottom:8px">$condition</div>
+              <table style="font-size:13px;border-collapse:collapse;width:100%">
+                <tr><td>Temp</td><td style="text-align:right"><b>$temp_str</b></td></tr>
+                $precip_rows
+                <tr><td>Cloud cover</td><td style="text-align:right"><b>$cloud_str</b></td></tr>
+                <tr><td>Visibility</td><td style="text-align:right"><b>$vis_str</b></td></tr>
+                <tr><td>Wind</td><td style="text-align:right"><b>$wind_str</b></td></tr>
+                <tr><td>Direction</td><td style="text-align:right"><b>$wind_dir</b></td></tr>
+              </table>
+              $wind_flag
+            </div>
+            """)
+
+_POPUP_UNAVAILABLE_TMPL = string.Template("""
+            <div style="font-family:sans-serif">
+              <b>$label</b><br>
+              <span style="color:#888">Arrives ~$arrival</span><br>
+              <span style="color:#aaa;font-size:12px">$reason</span>
+            </div>
+            """)
+
+_ROW = '<tr><td>{}</td><td style="text-align:right"><b>{}</b></td></tr>'
+
+# Popup precip rows by precip_type; "precip" is the fallback for any other
+# type when there is measurable precipitation
+_PRECIP_ROW_TMPL = {
+    "rain":          string.Template(_ROW.format("Rain", "$precip_str")),
+    "showers":       string.Template(_ROW.format("Rain", "$precip_str")),
+    "snow":          string.Template(_ROW.format("Snow", "$snow_str")),
+    "snow_showers":  string.Template(_ROW.format("Snow", "$snow_str")),
+    "freezing_rain": string.Template(_ROW.format("Frz. Rain", "$precip_str")),
+    "sleet":         string.Template(_ROW.format("Rain", "$precip_str")
+                                     + _ROW.format("Snow", "$snow_str")),
+    "thunderstorm":  string.Template(_ROW.format("Precip", "$precip_str")),
+    "precip":        string.Template(_ROW.format("Precip", "$precip_str")),
 }
 
+_WIND_FLAG_TMPL = string.Template(
+    '<div style="color:#E74C3C;font-weight:bold;margin-top:6px">&#9888; Extreme wind: $wind_mph mph</div>'
+)
+
+
+def _popup_html(label: str, arrival: str, weather: dict | None) -> str:
+    if not weather or not weather.get("available"):
+        reason = weather.get("reason", "Unavailable") if weather else "Unavailable"
+        return _POPUP_UNAVAILABLE_TMPL.substitute(label=label, arrival=arrival, reason=reason)
+
+    w = weather
+    fields = {
+        "label":      label,
+        "arrival":    arrival,
+        "condition":  w.get("condition", ""),
+        "temp_str":   f"{w['temp_f']:.1f}°F" if w["temp_f"] is not None else "—",
+        "precip_str": f"{w['precip_in_hr']:.3f} in/hr",
+        "snow_str":   f"{w['snowfall_in_hr']:.3f} in/hr",
+        "cloud_str":  f"{w['cloud_pct']:.0f}%",
+        "vis_str":    f"{w['vis_mi']:.1f} mi",
+        "wind_str":   f"{w['wind_mph']:.1f} mph",
+        "wind_dir":   w["wind_dir"],
+        "wind_flag":  (
+            _WIND_FLAG_TMPL.substitute(wind_mph=f"{w['wind_mph']:.0f}")
+            if w.get("wind_warning") else ""
+        ),
+    }
+
+    row_tmpl = _PRECIP_ROW_TMPL.get(w.get("precip_type"))
+    if row_tmpl is None and w["precip_in_hr"] > 0:
+        row_tmpl = _PRECIP_ROW_TMPL["precip"]
+    fields["precip_rows"] = row_tmpl.substitute(fields) if row_tmpl else ""
+
+    return _POPUP_TMPL.substitute(fields)
+
 
 # --- Map Builder --------------------------------------------------------------
 
-def build_map(coords_list, waypoints, start_addr, end_addr):
-    lons = [c[0] for c in coords_list]
-    lats = [c[1] for c in coords_list]
-    center = [(min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2]
+class _WaypointMarkers(MacroElement):
+    """
+    All weather waypoint markers as a single block of Leaflet JS.
+    Marker data is serialized once as a JSON array and looped over in the
+    browser, instead of building (and rendering) a folium CircleMarker,
+    Popup and Tooltip object per waypoint.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function (map) {
+                var style = {"color": "white", "weight": 1.5, "fill": true,
+                             "fillOpacity": 0.9, "radius": 9};
+                {{ this.markers_json }}.forEach(function (m) {
+                    L.circleMarker([m[0], m[1]], Object.assign({"fillColor": m[2]}, style))
+                        .bindPopup(m[3], {"maxWidth": 250})
+                        .bindTooltip(m[4], {"sticky": true})
+                        .addTo(map);
+                });
+            })({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, markers_json: str):
+        super().__init__()
+        self._name = "WaypointMarkers"
+        self.markers_json = markers_json
+
+
+# Rendered base maps (tiles, route line, start/end markers) keyed on the
+# route geometry and addresses. Re-planning the same route with a different
+# departure time only changes the waypoint markers, which are swapped in for
+# _MARKERS_PLACEHOLDER without re-rendering the rest of the map.
+_MARKERS_PLACEHOLDER = "__WAYPOINT_MARKERS__"
+_MAP_CACHE_SIZE = 32
+_MAP_CACHE: OrderedDict[tuple, str] = OrderedDict()
+_MAP_CACHE_LOCK = threading.Lock()
+
+
+def build_map(coords_list, waypoints: Waypoints, start_addr, end_addr):
+    coords = np.asarray(coords_list, dtype=np.float64)
+    key = (_route_hash(coords), start_addr, end_addr)
+
+    with _MAP_CACHE_LOCK:
+        base_html = _MAP_CACHE.get(key)
+        if base_html is not None:
+            _MAP_CACHE.move_to_end(key)
+
+    if base_html is None:
+        base_html = _build_base_map(coords, start_addr, end_addr)
+        with _MAP_CACHE_LOCK:
+            _MAP_CACHE[key] = base_html
+            if len(_MAP_CACHE) > _MAP_CACHE_SIZE:
+                _MAP_CACHE.popitem(last=False)
+
+    # The map document is embedded HTML-escaped in an iframe srcdoc, so the
+    # marker JS must be escaped the same way before it is swapped in
+    return base_html.replace(_MARKERS_PLACEHOLDER, html.escape(_markers_json(waypoints)))
+
+
+def _route_hash(coords: np.ndarray) -> str:
+    return hashlib.blake2b(memoryview(coords.tobytes()), digest_size=16).hexdigest()
+
+
+def _markers_json(waypoints: Waypoints) -> str:
+    """Serialize waypoint markers as a JSON array of [lat, lon, fill, popup html, tooltip]."""
+    markers = []
+    for i, (lat, lon) in enumerate(zip(waypoints.lat.tolist(), waypoints.lon.tolist())):
+        label   = waypoints.label[i]
+        arrival = waypoints.arrival_str[i]
+        weather = waypoints.weather[i]
+
+        _, fill_color = precip_dot_color(weather)
+        markers.append([
+            lat, lon, fill_color,
+            _popup_html(label, arrival, weather),
+            f"{label} — {arrival}",
+        ])
+
+    # Escape "</" so popup text can never close the surrounding <script>
+    return json.dumps(markers).replace("</", "<\\/")
+
+
+def _build_base_map(coords: np.ndarray, start_addr, end_addr) -> str:
+    """Render everything except the waypoint markers for an (N, 2) lon/lat array."""
+    lon_min, lat_min = coords[:, :2].min(axis=0).tolist()
+    lon_max, lat_max = coords[:, :2].max(axis=0).tolist()
+    center = [(lat_min + lat_max) / 2, (lon_min + lon_max) / 2]
 
     m = folium.Map(location=center, zoom_start=6, tiles="CartoDB positron")
 
     # Route line
     folium.PolyLine(
-        [[c[1], c[0]] for c in coords_list],
+        coords[:, [1, 0]].tolist(),
         color="#1A73E8", weight=5, opacity=0.85,
         tooltip="Planned Route"
     ).add_to(m)
 
     # Start / end markers
     folium.Marker(
-        location=[coords_list[0][1], coords_list[0][0]],
+        location=coords[0, [1, 0]].tolist(),
         popup=folium.Popup(f"<b>Start</b><br>{start_addr}", max_width=220),
         tooltip="Start",
         icon=folium.Icon(color="green", icon="play", prefix="fa"),
     ).add_to(m)
 
     folium.Marker(
-        location=[coords_list[-1][1], coords_list[-1][0]],
+        location=coords[-1, [1, 0]].tolist(),
         popup=folium.Popup(f"<b>Destination</b><br>{end_addr}", max_width=220),
         tooltip="Destination",
         icon=folium.Icon(color="red", icon="flag-checkered", prefix="fa"),
     ).add_to(m)
 
-    # Weather waypoint markers
-    for wp in waypoints:
-        lat, lon  = wp["lat"], wp["lon"]
-        label     = wp.get("label", f"Mile {wp['mile']}")
-        arrival   = wp.get("arrival_str", "")
-        weather   = wp.get("weather")
-
-        color      = precip_dot_color(weather)
-        fill_color = FILL_COLORS.get(color, "#3498DB")
-
-        if weather and weather.get("available"):
-            w = weather
-            temp_str    = f"{w['temp_f']:.1f}°F" if w["temp_f"] is not None else "—"
-            precip_str  = f"{w['precip_in_hr']:.3f} in/hr"
-            snow_str    = f"{w['snowfall_in_hr']:.3f} in/hr"
-            cloud_str   = f"{w['cloud_pct']:.0f}%"
-            vis_str     = f"{w['vis_mi']:.1f} mi"
-            wind_str    = f"{w['wind_mph']:.1f} mph"
-            condition   = w.get("condition", "")
-
-            # Build precip rows depending on what's falling
-            pt = w.get("precip_type")
-            precip_rows = ""
-            if pt in ("rain", "showers"):
-                precip_rows = f'<tr><td>Rain</td><td style="text-align:right"><b>{precip_str}</b></td></tr>'
-            elif pt in ("snow", "snow_showers"):
-                precip_rows = f'<tr><td>Snow</td><td style="text-align:right"><b>{snow_str}</b></td></tr>'
-            elif pt == "freezing_rain":
-                precip_rows = f'<tr><td>Frz. Rain</td><td style="text-align:right"><b>{precip_str}</b></td></tr>'
-            elif pt == "sleet":
-                precip_rows = (
-                    f'<tr><td>Rain</td><td style="text-align:right"><b>{precip_str}</b></td></tr>'
-                    f'<tr><td>Snow</td><td style="text-align:right"><b>{snow_str}</b></td></tr>'
-                )
-            elif pt == "thunderstorm":
-                precip_rows = f'<tr><td>Precip</td><td style="text-align:right"><b>{precip_str}</b></td></tr>'
-            elif w["precip_in_hr"] > 0:
-                precip_rows = f'<tr><td>Precip</td><td style="text-align:right"><b>{precip_str}</b></td></tr>'
-
-            wind_flag = (
-                f'<div style="color:#E74C3C;font-weight:bold;margin-top:6px">&#9888; Extreme wind: {w["wind_mph"]:.0f} mph</div>'
-                if w.get("wind_warning") else ""
-            )
-
-            popup_html = f"""
-            <div style="font-family:sans-serif;min-width:200px">
-              <div style="font-size:14px;font-weight:bold;margin-bottom:2px">{label}</div>
-              <div style="color:#888;font-size:12px;margin-bottom:6px">Arrives ~{arrival}</div>
-              <div style="font-size:12px;color:#555;margin-bottom:8px">{condition}</div>
-              <table style="font-size:13px;border-collapse:collapse;width:100%">
-                <tr><td>Temp</td><td style="text-align:right"><b>{temp_str}</b></td></tr>
-                {precip_rows}
-                <tr><td>Cloud cover</td><td style="text-align:right"><b>{cloud_str}</b></td></tr>
-                <tr><td>Visibility</td><td style="text-align:right"><b>{vis_str}</b></td></tr>
-                <tr><td>Wind</td><td style="text-align:right"><b>{wind_str}</b></td></tr>
-                <tr><td>Direction</td><td style="text-align:right"><b>{w['wind_dir']}</b></td></tr>
-              </table>
-              {wind_flag}
-            </div>
-            """
-        else:
-            reason = weather.get("reason", "Unavailable") if weather else "Unavailable"
-            popup_html = f"""
-            <div style="font-family:sans-serif">
-              <b>{label}</b><br>
-              <span style="color:#888">Arrives ~{arrival}</span><br>
-              <span style="color:#aaa;font-size:12px">{reason}</span>
-            </div>
-            """
-
-        folium.CircleMarker(
-            location=[lat, lon],
-            radius=9,
-            color="white",
-            weight=1.5,
-            fill=True,
-            fill_color=fill_color,
-            fill_opacity=0.9,
-            popup=folium.Popup(popup_html, max_width=250),
-            tooltip=f"{label} — {arrival}",
-        ).add_to(m)
-
-    m.fit_bounds([[min(lats), min(lons)], [max(lats), max(lons)]])
+    # Weather waypoint markers, filled in per request by build_map
+    _WaypointMarkers(_MARKERS_PLACEHOLDER).add_to(m)
+
+    m.fit_bounds([[lat_min, lon_min], [lat_max, lon_max]])
     return m._repr_html_()
 
 
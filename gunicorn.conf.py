@@ -0,0 +1,17 @@
+"""
+gunicorn.conf.py
+Production server settings, picked up automatically by `gunicorn app:app`.
+
+A /plan request spends most of its time waiting on Nominatim, ORS and
+Open-Meteo, so each worker runs a thread pool: a slow plan only ties up one
+thread instead of the whole process. Geocode, weather and map caches are
+per process, so a few workers with many threads share them better than
+many single-threaded workers.
+"""
+
+import os
+
+bind         = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = "gthread"
+workers      = int(os.environ.get("WEB_CONCURRENCY", 4))
+threads      = int(os.environ.get("GUNICORN_THREADS", 8))
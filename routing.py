@@ -4,18 +4,51 @@ Handles address geocoding (Nominatim), route fetching (OpenRouteService),
 waypoint sampling, and arrival time estimation.
 """
 
-import math
 import os
+import threading
+import time
+import numpy as np
+import orjson
 import requests
-from datetime import datetime, timedelta
+from dataclasses import dataclass, field
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone, tzinfo
+
+
+# --- HTTP session -------------------------------------------------------------
+
+# Shared session for Nominatim and ORS. HTTPAdapter pools connections per
+# host, so repeat calls to either service reuse a keep-alive socket.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
 
 # --- Geocoding ----------------------------------------------------------------
 
+# Geocoded coordinates for an address practically never change, so successful
+# lookups are kept for 30 days. Saves a Nominatim round trip (and its 1 req/s
+# rate limit) whenever the same start or end address is planned again.
+_GEOCODE_TTL_S = 30 * 24 * 3600
+_GEOCODE_CACHE: dict[str, tuple[float, tuple[float, float]]] = {}
+_GEOCODE_LOCK = threading.Lock()
+_GEOCODE_MAX_ENTRIES = 1024
+
+# Nominatim's usage policy allows at most 1 request per second per
+# application. Cache misses reserve a slot in this schedule before calling
+# out, so concurrent lookups in this process are spaced 1 s apart. The
+# schedule is per process, so under gunicorn the combined rate is 1/s times
+# the worker count; keep WEB_CONCURRENCY at 1 to stay strictly within policy.
+_NOMINATIM_INTERVAL_S = 1.0
+_NOMINATIM_LOCK = threading.Lock()
+_nominatim_next_at = 0.0
+
+
 def geocode(address: str) -> tuple[float, float] | None:
     """
     Convert an address string to (longitude, latitude) using Nominatim (OpenStreetMap).
     Free, no API key required. Returns None on failure.
+    Successful lookups are cached in-process, keyed on the lowercased,
+    whitespace-collapsed address.
 
     Nominatim's usage policy requires a descriptive User-Agent with a real
     contact email. Set CONTACT_EMAIL in your .env file -- requests with
@@ -30,6 +63,12 @@ def geocode(address: str) -> tuple[float, float] | None:
             "Add: CONTACT_EMAIL=you@yourdomain.com"
         )
 
+    key = " ".join(address.lower().split())
+    with _GEOCODE_LOCK:
+        entry = _GEOCODE_CACHE.get(key)
+    if entry is not None and time.monotonic() - entry[0] < _GEOCODE_TTL_S:
+        return entry[1]
+
     url = "https://nominatim.openstreetmap.org/search"
     params = {
         "q": address,
@@ -39,19 +78,36 @@ def geocode(address: str) -> tuple[float, float] | None:
     headers = {"User-Agent": f"RouteWeatherPlanner/1.0 ({contact})"}
 
     try:
-        resp = requests.get(url, params=params, headers=headers, timeout=10)
+        _wait_for_nominatim_slot()
+        resp = _SESSION.get(url, params=params, headers=headers, timeout=10)
         resp.raise_for_status()
-        results = resp.json()
+        results = orjson.loads(resp.content)
         if not results:
             return None
         lon = float(results[0]["lon"])
         lat = float(results[0]["lat"])
+        with _GEOCODE_LOCK:
+            _GEOCODE_CACHE.pop(key, None)   # re-insert at the end so order tracks age
+            if len(_GEOCODE_CACHE) >= _GEOCODE_MAX_ENTRIES:
+                _GEOCODE_CACHE.pop(next(iter(_GEOCODE_CACHE)))   # evict oldest
+            _GEOCODE_CACHE[key] = (time.monotonic(), (lon, lat))
         return (lon, lat)
     except Exception as e:
         print(f"[geocode] Error: {e}")
         return None
 
 
+def _wait_for_nominatim_slot() -> None:
+    """Block until at least _NOMINATIM_INTERVAL_S has passed since the previous request."""
+    global _nominatim_next_at
+    with _NOMINATIM_LOCK:
+        now  = time.monotonic()
+        wait = _nominatim_next_at - now
+        _nominatim_next_at = max(now, _nominatim_next_at) + _NOMINATIM_INTERVAL_S
+    if wait > 0:
+        time.sleep(wait)
+
+
 # --- Routing ------------------------------------------------------------------
 
 def get_route(start: tuple, end: tuple, api_key: str) -> dict | None:
@@ -76,9 +132,9 @@ def get_route(start: tuple, end: tuple, api_key: str) -> dict | None:
     }
 
     try:
-        resp = requests.post(url, json=body, headers=headers, timeout=30)
+        resp = _SESSION.post(url, json=body, headers=headers, timeout=30)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
 
         feature  = data["features"][0]
         coords   = feature["geometry"]["coordinates"]
@@ -102,79 +158,141 @@ def get_route(start: tuple, end: tuple, api_key: str) -> dict | None:
 
 # --- Geometry helpers ---------------------------------------------------------
 
-def haversine_mi(lon1, lat1, lon2, lat2) -> float:
-    """Great-circle distance in miles between two lon/lat points."""
+def haversine_mi(lon1, lat1, lon2, lat2):
+    """
+    Great-circle distance in miles between two lon/lat points.
+    Accepts scalars or equal-length NumPy arrays (one distance per pair).
+    """
     R = 3958.8
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlam = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlam / 2) ** 2
-    return 2 * R * math.asin(math.sqrt(a))
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi = phi2 - phi1
+    dlam = np.radians(lon2) - np.radians(lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlam / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(a))
 
 
-def interpolate_point(lon1, lat1, lon2, lat2, frac: float) -> tuple[float, float]:
-    """Linearly interpolate a point between two coordinates."""
+def interpolate_point(lon1, lat1, lon2, lat2, frac):
+    """Linearly interpolate a point between two coordinates (scalars or arrays)."""
     return (lon1 + (lon2 - lon1) * frac, lat1 + (lat2 - lat1) * frac)
 
 
+# --- Waypoint container --------------------------------------------------------
+
+@dataclass
+class Waypoints:
+    """
+    Waypoints along a route in struct-of-arrays layout: one array (or list)
+    per field, all indexed by waypoint. Each pipeline stage fills in its own
+    fields, so per-waypoint math stays vectorized; to_dicts() produces the
+    per-waypoint dicts the templates expect.
+    """
+    lon:         np.ndarray
+    lat:         np.ndarray
+    mile:        np.ndarray
+    label:       list[str]
+    arrival_ts:  np.ndarray | None = None     # POSIX seconds, set by estimate_arrival_times
+    arrival_str: list[str] = field(default_factory=list)
+    tz:          tzinfo | None = None         # departure time zone, None for naive input
+    weather:     list[dict | None] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.lon)
+
+    def arrival_utc(self, i: int) -> datetime:
+        """Naive UTC arrival time of waypoint i (naive departures are treated as UTC)."""
+        return datetime.fromtimestamp(self.arrival_ts[i], timezone.utc).replace(tzinfo=None)
+
+    def arrival_dt(self, i: int) -> datetime:
+        """Arrival time of waypoint i in the departure's time zone (naive if it was naive)."""
+        dt = datetime.fromtimestamp(self.arrival_ts[i], self.tz or timezone.utc)
+        return dt if self.tz is not None else dt.replace(tzinfo=None)
+
+    def to_dicts(self) -> list[dict]:
+        wps = []
+        for i, (lon, lat, mile) in enumerate(zip(self.lon.tolist(), self.lat.tolist(), self.mile.tolist())):
+            wp = {"lon": lon, "lat": lat, "mile": mile, "label": self.label[i]}
+            if self.arrival_ts is not None:
+                wp["arrival_dt"]  = self.arrival_dt(i)
+                wp["arrival_str"] = self.arrival_str[i]
+            if self.weather:
+                wp["weather"] = self.weather[i]
+            wps.append(wp)
+        return wps
+
+
 # --- Waypoint sampling -------------------------------------------------------
 
-def sample_waypoints(coords: list, interval_mi: float, total_dist_mi: float) -> list[dict]:
+def sample_waypoints(coords: list, interval_mi: float, total_dist_mi: float) -> Waypoints:
     """
     Walk along the route geometry and pick a waypoint every interval_mi miles.
     Always includes the destination as the final waypoint.
     """
-    waypoints = []
-    accumulated = 0.0
-    next_target = interval_mi
-    wp_index = 1
-
-    prev_lon, prev_lat = coords[0]
-
-    for i in range(1, len(coords)):
-        cur_lon, cur_lat = coords[i]
-        seg_dist = haversine_mi(prev_lon, prev_lat, cur_lon, cur_lat)
-
-        while next_target <= accumulated + seg_dist:
-            frac = (next_target - accumulated) / seg_dist
-            lon, lat = interpolate_point(prev_lon, prev_lat, cur_lon, cur_lat, frac)
-            waypoints.append({
-                "lon":   lon,
-                "lat":   lat,
-                "mile":  round(next_target, 1),
-                "label": f"Checkpoint {wp_index} (Mile {round(next_target, 0):.0f})",
-            })
-            wp_index += 1
-            next_target += interval_mi
-
-        accumulated += seg_dist
-        prev_lon, prev_lat = cur_lon, cur_lat
-
-    end_lon, end_lat = coords[-1]
-    waypoints.append({
-        "lon":   end_lon,
-        "lat":   end_lat,
-        "mile":  round(total_dist_mi, 1),
-        "label": f"Destination (Mile {round(total_dist_mi, 0):.0f})",
-    })
+    arr = np.asarray(coords, dtype=np.float64)
+    cp_lons, cp_lats, cp_miles = _sample_waypoints_core(arr[:, 0], arr[:, 1], interval_mi)
+
+    labels = [
+        f"Checkpoint {wp_index} (Mile {round(mile, 0):.0f})"
+        for wp_index, mile in enumerate(cp_miles.tolist(), start=1)
+    ]
+    labels.append(f"Destination (Mile {round(total_dist_mi, 0):.0f})")
+
+    return Waypoints(
+        lon   = np.append(cp_lons, arr[-1, 0]),
+        lat   = np.append(cp_lats, arr[-1, 1]),
+        mile  = np.append(np.round(cp_miles, 1), round(total_dist_mi, 1)),
+        label = labels,
+    )
+
+
+def _sample_waypoints_core(
+    lons: np.ndarray, lats: np.ndarray, interval_mi: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Array-only core of sample_waypoints: the lon, lat and route mile of every
+    interval_mi checkpoint along the polyline, destination excluded.
 
-    return waypoints
+    All segment lengths are computed in one vectorized pass; each checkpoint
+    distance is then located on the cumulative distance with searchsorted,
+    so there is no per-point Python loop left to compile or unroll.
+    """
+    seg_dist = haversine_mi(lons[:-1], lats[:-1], lons[1:], lats[1:])
+    cum_dist = np.concatenate(([0.0], np.cumsum(seg_dist)))   # miles at each point
+
+    n_checkpoints = int(cum_dist[-1] // interval_mi)
+    targets = interval_mi * np.arange(1, n_checkpoints + 1, dtype=np.float64)
+    targets = targets[targets <= cum_dist[-1]]
+
+    # Segment i runs from point i to i+1; pick the first whose end reaches each target
+    seg_idx = np.searchsorted(cum_dist, targets, side="left") - 1
+    frac    = (targets - cum_dist[seg_idx]) / seg_dist[seg_idx]
+    cp_lons, cp_lats = interpolate_point(
+        lons[seg_idx], lats[seg_idx], lons[seg_idx + 1], lats[seg_idx + 1], frac
+    )
+    return cp_lons, cp_lats, targets
 
 
 # --- Arrival time estimation -------------------------------------------------
 
 def estimate_arrival_times(
-    waypoints: list[dict],
+    waypoints: Waypoints,
     departure_dt: datetime,
     avg_speed_mph: float = 60.0,
-) -> list[dict]:
+) -> Waypoints:
     """
     Estimate the wall-clock arrival time at each waypoint.
-    Adds 'arrival_dt' and 'arrival_str' to each waypoint dict.
+    Fills in 'arrival_ts', 'arrival_str' and 'tz' on waypoints.
     """
-    for wp in waypoints:
-        hours_elapsed = wp["mile"] / avg_speed_mph
-        arrival = departure_dt + timedelta(hours=hours_elapsed)
-        wp["arrival_dt"]  = arrival
-        wp["arrival_str"] = arrival.strftime("%a %b %-d, %I:%M %p")
+    if departure_dt.tzinfo is None:
+        # Naive departures are wall-clock times; pin them to UTC so the
+        # round trip through a timestamp leaves them unchanged
+        depart_ts = departure_dt.replace(tzinfo=timezone.utc).timestamp()
+    else:
+        depart_ts = departure_dt.timestamp()
+
+    waypoints.tz          = departure_dt.tzinfo
+    waypoints.arrival_ts  = depart_ts + waypoints.mile / avg_speed_mph * 3600
+    waypoints.arrival_str = [
+        waypoints.arrival_dt(i).strftime("%a %b %-d, %I:%M %p")
+        for i in range(len(waypoints))
+    ]
     return waypoints
@@ -26,16 +26,75 @@ precipitation_type codes (ECMWF native diagnostic):
 API docs: https://open-meteo.com/en/docs/ecmwf-api
 """
 
+import functools
+import math
+import threading
+import time
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 
+from routing import Waypoints
+
 
 # --- Constants ----------------------------------------------------------------
 
 # ECMWF-specific endpoint — gives native precipitation_type and snowfall
 OPEN_METEO_URL = "https://api.open-meteo.com/v1/ecmwf"
 
+# Shared session so batch requests reuse pooled keep-alive connections
+# instead of paying a fresh TCP + TLS handshake every call. Batch fan-out
+# is capped at the pool size so no worker ever waits on a socket.
+# Transient gateway errors (502/503/504) are retried with a short exponential
+# backoff (0.5 s, 1 s, 2 s) before a batch is given up on. Connection errors
+# and read timeouts are not retried, so a hung server costs one 15 s timeout
+# rather than four. 429 is not retried here either: the retries would bypass
+# the token bucket below, so a rate-limited batch goes straight to the
+# cooldown. Retry-After is ignored, since it is unbounded and would block a
+# /plan request for however long the server asks.
+_POOL_SIZE = 16
+_RETRY = Retry(
+    total=3,
+    connect=0,
+    read=0,
+    backoff_factor=0.5,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=["GET"],
+    respect_retry_after_header=False,
+    raise_on_status=False,
+)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=_POOL_SIZE, pool_maxsize=_POOL_SIZE, max_retries=_RETRY,
+))
+
+# Client-side token bucket. Open-Meteo counts every location in a
+# multi-location request as a separate call, so each request takes one token
+# per location. The bucket holds a minute's budget (600) and refills at
+# 10/s, so normal traffic never waits and only a sustained burst sleeps
+# until enough tokens have refilled. The bucket is per process, so under
+# gunicorn the combined rate is this times the worker count. If the API
+# answers 429 anyway, all fetches are skipped for a cooldown instead of
+# re-hitting it on every /plan.
+_BUCKET_CAPACITY       = 600
+_BUCKET_REFILL_PER_S   = 10.0
+_RATE_LIMIT_COOLDOWN_S = 60
+_THROTTLE_LOCK  = threading.Lock()
+_bucket_tokens  = float(_BUCKET_CAPACITY)
+_bucket_updated = time.monotonic()
+_cooldown_until = 0.0
+
+# Decoded forecasts are cached per ~0.1° grid cell and arrival hour.
+# ECMWF IFS only updates 4x/day, so an hour-old answer is still current.
+_CACHE_TTL_S = 3600
+_CACHE_MAX_ENTRIES = 10_000
+_CACHE: dict[tuple, tuple[float, dict]] = {}
+_CACHE_LOCK = threading.Lock()
+
 
 # --- Precipitation type decoder -----------------------------------------------
 
@@ -100,47 +159,104 @@ _WMO_PRECIP_TYPE = {
 }
 
 
+@functools.lru_cache(maxsize=256)
+def _resolve_condition(precip_type_code, wmo_int: int | None) -> tuple[str | None, str]:
+    """
+    Combine the ECMWF precipitation_type code and the WMO weather_code into
+    (precip_type, condition label). Only a few dozen code pairs exist, so
+    results are memoized and a batch decode is mostly cache hits.
+    """
+    # Decode precipitation type from ECMWF native codes (most authoritative)
+    pt_decoded  = decode_precipitation_type(precip_type_code)
+    precip_type = pt_decoded["precip_type"]
+    condition   = pt_decoded["label"]
+
+    # Refine with WMO weather_code for conditions not in precipitation_type:
+    # showers, snow showers, thunderstorm, fog are better captured there
+    if wmo_int is not None:
+        wmo_override = _WMO_PRECIP_TYPE.get(wmo_int)
+        wmo_label    = _WMO_LABEL.get(wmo_int)
+        # Use WMO for non-precip refinements (fog, thunderstorm, showers)
+        # but don't let WMO override a more specific ECMWF precip_type
+        if wmo_override in ("fog", "thunderstorm"):
+            precip_type = wmo_override
+            condition   = wmo_label
+        elif precip_type is None and wmo_override:
+            precip_type = wmo_override
+            condition   = wmo_label
+        elif precip_type is None and wmo_label:
+            condition = wmo_label   # use WMO for clear/cloudy descriptions
+
+    return precip_type, condition
+
+
 # --- Public API ---------------------------------------------------------------
 
+# Open-Meteo accepts comma-separated coordinate lists, but very long lists
+# push the query string past typical URL length limits. Routes with more
+# waypoints than this are split into batches fetched in parallel.
+_MAX_BATCH_SIZE = 100
+
+
 def fetch_weather_for_waypoints(
-    waypoints: list[dict],
+    waypoints: Waypoints,
     token: str,
     repo: str,
     wind_warning_mph: float = 40.0,
-) -> list[dict]:
-    """Fetch weather for all waypoints in parallel using Open-Meteo ECMWF."""
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        futures = {
-            executor.submit(_fetch_one, wp, wind_warning_mph): i
-            for i, wp in enumerate(waypoints)
-        }
-        for future in as_completed(futures):
-            idx = futures[future]
-            try:
-                waypoints[idx]["weather"] = future.result()
-            except Exception as e:
-                print(f"[weather] Error for waypoint {idx}: {e}")
-                waypoints[idx]["weather"] = _weather_unavailable(str(e))
+) -> Waypoints:
+    """
+    Fetch weather for all waypoints using Open-Meteo ECMWF.
+    Waypoints with a fresh cached forecast are filled in directly. The rest
+    go out in a single multi-location request; only routes longer than
+    _MAX_BATCH_SIZE waypoints fall back to parallel batches.
+    """
+    keys = _cache_keys(waypoints, wind_warning_mph)
+    waypoints.weather = [_cache_get(key) for key in keys]
+    pending = [i for i, weather in enumerate(waypoints.weather) if weather is None]
+
+    batches = [
+        pending[i:i + _MAX_BATCH_SIZE]
+        for i in range(0, len(pending), _MAX_BATCH_SIZE)
+    ]
+
+    if len(batches) <= 1:
+        for batch in batches:
+            _fetch_batch_safe(waypoints, batch, keys, wind_warning_mph)
+        return waypoints
+
+    with ThreadPoolExecutor(max_workers=min(len(batches), _POOL_SIZE)) as executor:
+        for future in as_completed(
+            executor.submit(_fetch_batch_safe, waypoints, batch, keys, wind_warning_mph)
+            for batch in batches
+        ):
+            future.result()
 
     return waypoints
 
 
 # --- Internal helpers ---------------------------------------------------------
 
-def _fetch_one(wp: dict, wind_warning_mph: float) -> dict:
-    """Fetch hourly weather from Open-Meteo ECMWF for a single waypoint."""
-    lat = wp["lat"]
-    lon = wp["lon"]
-    arrival_dt: datetime = wp["arrival_dt"]
+def _fetch_batch_safe(
+    waypoints: Waypoints, batch: list[int], keys: list[tuple], wind_warning_mph: float
+) -> None:
+    """Fill weather for a batch of waypoint indices, marking all unavailable on error."""
+    try:
+        _fetch_batch(waypoints, batch, keys, wind_warning_mph)
+    except Exception as e:
+        print(f"[weather] Error for batch of {len(batch)} waypoints: {e}")
+        for i in batch:
+            waypoints.weather[i] = _weather_unavailable(str(e))
+
 
-    if arrival_dt.tzinfo is not None:
-        arrival_utc = arrival_dt.astimezone(timezone.utc).replace(tzinfo=None)
-    else:
-        arrival_utc = arrival_dt
+def _fetch_batch(
+    waypoints: Waypoints, batch: list[int], keys: list[tuple], wind_warning_mph: float
+) -> None:
+    """Fetch hourly weather from Open-Meteo ECMWF for a batch of waypoints in one request."""
+    arrivals = [waypoints.arrival_utc(i) for i in batch]
 
     params = {
-        "latitude":           lat,
-        "longitude":          lon,
+        "latitude":           ",".join(str(lat) for lat in waypoints.lat[batch].tolist()),
+        "longitude":          ",".join(str(lon) for lon in waypoints.lon[batch].tolist()),
         "hourly":             ",".join([
                                   "temperature_2m",
                                   "precipitation",
@@ -157,21 +273,129 @@ def _fetch_one(wp: dict, wind_warning_mph: float) -> dict:
         "temperature_unit":   "fahrenheit",
         "wind_speed_unit":    "mph",
         "precipitation_unit": "inch",
-        "forecast_days":      15,
+        "forecast_days":      _forecast_days_needed(max(arrivals)),
         "timezone":           "UTC",
     }
 
-    resp = requests.get(OPEN_METEO_URL, params=params, timeout=15)
+    if time.monotonic() < _cooldown_until:
+        for i in batch:
+            waypoints.weather[i] = _weather_unavailable(
+                "Open-Meteo rate limit reached, try again in a minute."
+            )
+        return
+
+    _throttle(len(batch))
+    resp = _SESSION.get(OPEN_METEO_URL, params=params, timeout=15)
+
+    if resp.status_code == 429:
+        _start_cooldown()
 
     if resp.status_code != 200:
-        return _weather_unavailable(f"Open-Meteo returned HTTP {resp.status_code}")
+        for i in batch:
+            waypoints.weather[i] = _weather_unavailable(
+                f"Open-Meteo returned HTTP {resp.status_code}"
+            )
+        return
+
+    data = orjson.loads(resp.content)
+
+    # A single location comes back as one object, multiple as a parallel list
+    blocks = data if isinstance(data, list) else [data]
+    if len(blocks) != len(batch):
+        raise ValueError(
+            f"Open-Meteo returned {len(blocks)} locations for {len(batch)} waypoints."
+        )
+
+    for i, block, arrival_utc in zip(batch, blocks, arrivals):
+        weather = _decode_block(block, arrival_utc, wind_warning_mph)
+        if weather["available"]:
+            _cache_put(keys[i], weather)
+        waypoints.weather[i] = weather
 
-    data = resp.json()
 
-    if "hourly" not in data:
+def _throttle(n_locations: int) -> None:
+    """
+    Take n_locations tokens from the bucket, sleeping only if it runs dry.
+    The balance may go negative; the deficit is the wait, so concurrent
+    callers queue up fairly behind each other.
+    """
+    global _bucket_tokens, _bucket_updated
+    with _THROTTLE_LOCK:
+        now = time.monotonic()
+        _bucket_tokens = min(
+            _BUCKET_CAPACITY,
+            _bucket_tokens + (now - _bucket_updated) * _BUCKET_REFILL_PER_S,
+        )
+        _bucket_updated = now
+        _bucket_tokens -= n_locations
+        wait = -_bucket_tokens / _BUCKET_REFILL_PER_S if _bucket_tokens < 0 else 0.0
+    if wait > 0:
+        time.sleep(wait)
+
+
+def _start_cooldown() -> None:
+    global _cooldown_until
+    with _THROTTLE_LOCK:
+        _cooldown_until = time.monotonic() + _RATE_LIMIT_COOLDOWN_S
+
+
+def _forecast_days_needed(latest_arrival_utc: datetime) -> int:
+    """
+    Smallest forecast_days that still covers the latest arrival, plus a day
+    of slack for the 12-hour nearest-hour tolerance. Each day trimmed is 24
+    fewer values per variable per waypoint in the response.
+    """
+    today = datetime.now(timezone.utc).date()
+    return max(1, min(15, (latest_arrival_utc.date() - today).days + 2))
+
+
+def _cache_keys(waypoints: Waypoints, wind_warning_mph: float) -> list[tuple]:
+    """
+    Cache key per waypoint: ~0.1° grid cell plus the arrival rounded to the
+    nearest hour (ties go earlier, matching _nearest_hour_index).
+    """
+    lat_cells = np.round(waypoints.lat, 1).tolist()
+    lon_cells = np.round(waypoints.lon, 1).tolist()
+    hours     = np.ceil(waypoints.arrival_ts / 3600 - 0.5).astype(np.int64).tolist()
+    return [
+        (lat, lon, hour, wind_warning_mph)
+        for lat, lon, hour in zip(lat_cells, lon_cells, hours)
+    ]
+
+
+def _cache_get(key: tuple) -> dict | None:
+    with _CACHE_LOCK:
+        entry = _CACHE.get(key)
+        if entry is None:
+            return None
+        ts, weather = entry
+        if time.monotonic() - ts >= _CACHE_TTL_S:
+            del _CACHE[key]
+            return None
+    return dict(weather)
+
+
+def _cache_put(key: tuple, weather: dict) -> None:
+    now = time.monotonic()
+    with _CACHE_LOCK:
+        # Entries are always (re)inserted at the end, so insertion order is
+        # age order: evict from the front while the oldest entry is expired
+        # or the cache is at its cap. No full scan, and never over the cap.
+        _CACHE.pop(key, None)
+        while _CACHE:
+            oldest = next(iter(_CACHE))
+            if len(_CACHE) < _CACHE_MAX_ENTRIES and now - _CACHE[oldest][0] < _CACHE_TTL_S:
+                break
+            del _CACHE[oldest]
+        _CACHE[key] = (now, dict(weather))
+
+
+def _decode_block(block: dict, arrival_utc: datetime, wind_warning_mph: float) -> dict:
+    """Decode one location's hourly block into the weather dict for arrival_utc."""
+    if "hourly" not in block:
         return _weather_unavailable("No hourly data in Open-Meteo response.")
 
-    hourly = data["hourly"]
+    hourly = block["hourly"]
     times  = hourly.get("time", [])
 
     if not times:
@@ -211,27 +435,8 @@ def _fetch_one(wp: dict, wind_warning_mph: float) -> dict:
     vis_mi   = (vis_m or 0.0) / 1609.34
     wind_dir = _degrees_to_compass(wind_deg)
 
-    # Decode precipitation type from ECMWF native codes (most authoritative)
-    pt_decoded   = decode_precipitation_type(precip_type_code)
-    precip_type  = pt_decoded["precip_type"]
-    condition    = pt_decoded["label"]
-
-    # Refine with WMO weather_code for conditions not in precipitation_type:
-    # showers, snow showers, thunderstorm, fog are better captured there
     wmo_int = int(weather_code) if weather_code is not None else None
-    if wmo_int is not None:
-        wmo_override = _WMO_PRECIP_TYPE.get(wmo_int)
-        wmo_label    = _WMO_LABEL.get(wmo_int)
-        # Use WMO for non-precip refinements (fog, thunderstorm, showers)
-        # but don't let WMO override a more specific ECMWF precip_type
-        if wmo_override in ("fog", "thunderstorm"):
-            precip_type = wmo_override
-            condition   = wmo_label
-        elif precip_type is None and wmo_override:
-            precip_type = wmo_override
-            condition   = wmo_label
-        elif precip_type is None and wmo_label:
-            condition = wmo_label   # use WMO for clear/cloudy descriptions
+    precip_type, condition = _resolve_condition(precip_type_code, wmo_int)
 
     return {
         "temp_f":          round(temp_f, 1) if temp_f is not None else None,
@@ -253,18 +458,26 @@ def _fetch_one(wp: dict, wind_warning_mph: float) -> dict:
 
 
 def _nearest_hour_index(times: list[str], target: datetime) -> int | None:
-    best_idx  = None
-    best_diff = float("inf")
-    for i, t_str in enumerate(times):
-        try:
-            t = datetime.fromisoformat(t_str)
-        except ValueError:
-            continue
-        diff = abs((t - target).total_seconds())
-        if diff < best_diff:
-            best_diff = diff
-            best_idx  = i
-    return best_idx if best_diff <= 12 * 3600 else None
+    """
+    Index of the hourly slot closest to target (ties go to the earlier hour),
+    or None if the nearest slot is more than 12 hours away.
+    Open-Meteo hourly times are evenly spaced one hour apart, so only the
+    first timestamp needs parsing.
+    """
+    try:
+        t0 = _parse_hour(times[0])
+    except ValueError:
+        return None
+    offset_hrs = (target - t0).total_seconds() / 3600
+    idx = min(max(math.ceil(offset_hrs - 0.5), 0), len(times) - 1)
+    return idx if abs(offset_hrs - idx) <= 12 else None
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_hour(t_str: str) -> datetime:
+    # Every block in a batch response (and every response fetched the same
+    # day) starts at the same hour, so this parses once and then hits the cache
+    return datetime.fromisoformat(t_str)
 
 
 def _weather_unavailable(reason: str) -> dict:
@@ -288,9 +501,14 @@ def _weather_unavailable(reason: str) -> dict:
     }
 
 
+_COMPASS_POINTS = ["N","NNE","NE","ENE","E","ESE","SE","SSE",
+                   "S","SSW","SW","WSW","W","WNW","NW","NNW"]
+
+# Compass point for every 0.1° step, so a lookup is a single index
+_COMPASS_TABLE = [_COMPASS_POINTS[round(tenths / 10 / 22.5) % 16] for tenths in range(3600)]
+
+
 def _degrees_to_compass(degrees: float | None) -> str:
     if degrees is None:
         return "—"
-    directions = ["N","NNE","NE","ENE","E","ESE","SE","SSE",
-                  "S","SSW","SW","WSW","W","WNW","NW","NNW"]
-    return directions[round(degrees / 22.5) % 16]
+    return _COMPASS_TABLE[round(degrees * 10) % 3600]